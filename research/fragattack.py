@@ -13,12 +13,15 @@ from fraginternals import *
 def cleanup():
 	daemon.stop()
 
+# Characters used in the --actions argument
+TRIGGER_CHARS = {'S': Action.StartAuth, 'B': Action.BeforeAuth, 'A': Action.AfterAuth, 'C': Action.Connected}
+ACTION_CHARS = {'I': dict(action=Action.GetIp), 'F': dict(action=Action.Rekey),
+		'R': dict(action=Action.Reconnect), 'P': dict(enc=False), 'E': dict(enc=True)}
+
 def char2trigger(c):
-	if c == 'S': return Action.StartAuth
-	elif c == 'B': return Action.BeforeAuth
-	elif c == 'A': return Action.AfterAuth
-	elif c == 'C': return Action.Connected
-	else: raise Exception("Unknown trigger character " + c)
+	trigger = TRIGGER_CHARS.get(c)
+	if trigger == None: raise Exception("Unknown trigger character " + c)
+	return trigger
 
 def stract2action(stract):
 	"""Parse a single trigger and action pair"""
@@ -30,19 +33,11 @@ def stract2action(stract):
 		trigger = char2trigger(stract[0])
 		c = stract[1]
 
-	if c == 'I':
-		return Action(trigger, action=Action.GetIp)
-	elif c == 'F':
-		return Action(trigger, action=Action.Rekey)
-	elif c == 'R':
-		return Action(trigger, action=Action.Reconnect)
-	elif c == 'P':
-		return Action(trigger, enc=False)
-	elif c == 'E':
-		return Action(trigger, enc=True)
-	elif c == 'D':
+	if c == 'D':
 		# Note: the trigger condition of MetaDrop is ignored
 		return Action(meta_action=Action.MetaDrop)
+	elif c in ACTION_CHARS:
+		return Action(trigger, **ACTION_CHARS[c])
 
 	raise Exception("Unrecognized action")
 
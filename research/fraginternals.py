@@ -5,27 +5,114 @@
 # See README for more details.
 
 from libwifi import *
-import abc, sys, socket, struct, time, subprocess, atexit, select, copy
+import abc, sys, socket, struct, time, subprocess, atexit, selectors, collections, heapq, itertools
 import os.path
 from wpaspy import Ctrl
-from scapy.contrib.wpa_eapol import WPA_key
 from scapy.arch.common import get_if_raw_hwaddr
 
 FRAGVERSION = "1.3"
 
+# Only ARP, IPv4, IPv6, and EAPOL frames are handled on the Ethernet interface. This
+# doesn't depend on the test type: ARP, DHCP, and EAPOL are all needed to connect.
+ETH_FILTER = compile_ethertype_filter([ETH_P_ARP, ETH_P_IP, ETH_P_IPV6, 0x888e])
+
 # ----------------------------------- Utility Commands -----------------------------------
 
-def croprepr(p, length=175):
-	string = repr(p)
+def cropstr(string, length=175):
 	if len(string) > length:
 		return string[:length - 3] + "..."
 	return string
 
+def croprepr(p, length=175):
+	return cropstr(repr(p), length)
+
+def dot11_header_repr(header):
+	"""Describe a serialized Dot11 data header without having to parse it using scapy"""
+	addr1, addr2, addr3 = [str2mac(bytes(header[i:i + 6])) for i in [4, 10, 16]]
+	SC = struct.unpack_from("<H", header, 22)[0]
+	string = f"<Dot11 FCfield={header[1]:#x} addr1={addr1} addr2={addr2} addr3={addr3} SC={SC}"
+	# Include the TID of QoS Data frames
+	if header[0] & 0x80:
+		string += f" TID={header[24] & 0x0f}"
+	return string + " |"
+
 def log_level2switch(options):
 	if options.debug >= 2: return ["-dd", "-K"]
 	elif options.debug >= 1: return ["-d", "-K"]
 	return ["-K"]
 
+def wpaspy_get_event(msg):
+	"""Strip the "<level>" prefix of an event on the control interface"""
+	if msg.startswith("<"):
+		return msg[msg.find(">") + 1:]
+	return msg
+
+def eapol_get_key_info(eapol):
+	"""Get the Key Information field of a raw EAPOL-Key frame, or None for other EAPOL frames"""
+	# Version (1 byte), packet type (1 byte), length (2 bytes), descriptor type (1 byte)
+	if len(eapol) < 7 or eapol[1] != 3:
+		return None
+	return struct.unpack_from(">H", eapol, 5)[0]
+
+def dhcp_get_message_type(p):
+	"""Get the DHCP message type by scanning the raw options of a received DHCP packet"""
+	# Only received packets contain the original bytes
+	options = p[DHCP].original
+	if not options:
+		options = raw(p[DHCP])
+
+	i = 0
+	while i + 1 < len(options):
+		code, length = options[i], options[i + 1]
+		if code == 0:
+			# Pad option
+			i += 1
+		elif code == 255:
+			# End option
+			break
+		elif code == 53 and length >= 1 and i + 2 < len(options):
+			return options[i + 2]
+		else:
+			i += 2 + length
+
+	return None
+
+def bootp_get_offset(frame, to_server=False):
+	"""Get the offset of the BOOTP header in a raw Ethernet frame sent from (or to) the BOOTP server port"""
+	if len(frame) < 34 or frame[12:14] != b"\x08\x00" or frame[23] != 17:
+		return None
+	udp = 14 + (frame[14] & 0x0f) * 4
+	# The fixed part of the BOOTP header is 236 bytes
+	ports = b"\x00\x44\x00\x43" if to_server else b"\x00\x43\x00\x44"
+	if len(frame) < udp + 8 + 236 or frame[udp:udp + 4] != ports:
+		return None
+	return udp + 8
+
+def bootp_get_xid(frame):
+	"""Get the XID of a raw Ethernet frame sent from the BOOTP server port, or None otherwise"""
+	offset = bootp_get_offset(frame)
+	if offset == None:
+		return None
+	return struct.unpack_from(">I", frame, offset + 4)[0]
+
+def dhcp_build_message(xid, chaddr, options):
+	"""
+	Build the IP/UDP/BOOTP/DHCP bytes of a broadcast DHCP client message. Here options
+	is a list of (code, value) tuples, and the end option is appended automatically.
+	"""
+	dhcp = b"".join([struct.pack("BB", code, len(value)) + value for code, value in options]) + b"\xff"
+	bootp = struct.pack(">BBBBIHH4s4s4s4s16s64s128s4s", 1, 1, 6, 0, xid, 0, 0, b"", b"", b"", b"",
+			    chaddr, b"", b"", b"\x63\x82\x53\x63") + dhcp
+
+	src, dst = b"\x00" * 4, b"\xff" * 4
+	udp = struct.pack(">HHHH", 68, 67, 8 + len(bootp), 0) + bootp
+	udp_chksum = checksum(src + dst + struct.pack(">HH", 17, len(udp)) + udp)
+	udp = udp[:6] + struct.pack(">H", 0xffff if udp_chksum == 0 else udp_chksum) + udp[8:]
+
+	ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 1, 0, 64, 17, 0, src, dst)
+	ip = ip[:10] + struct.pack(">H", checksum(ip)) + ip[12:]
+	return ip + udp
+
 def freebsd_create_eapolmsdu(src, dst, toinject):
 	"""
 	FreeBSD doesn't properly parse A-MSDU frames that start with an
@@ -72,7 +159,7 @@ def generate_request(sta, ptype, prior=2, icmp_size=None, padding=None, to_self=
 	header = sta.get_header(prior=prior)
 
 	# Test handle the client handles Ethernet frames with the same src and dst MAC address
-	to_ds = header.FCfield & Dot11(FCfield="to-DS").FCfield != 0
+	to_ds = header.FCfield & 1 != 0
 	if to_self and to_ds:
 		log(ERROR, "Impossible test! Can't send frames to the AP where both Ethernet dst and src are the same.")
 	elif to_self:
@@ -110,9 +197,8 @@ def generate_request(sta, ptype, prior=2, icmp_size=None, padding=None, to_self=
 
 		check = lambda p: BOOTP in p and p[BOOTP].xid == xid and p[BOOTP].op == 2
 
-		rawmac = bytes.fromhex(sta.mac.replace(':', ''))
 		request = LLC()/SNAP()/IP(src="0.0.0.0", dst="255.255.255.255")
-		request = request/UDP(sport=68, dport=67)/BOOTP(op=1, chaddr=rawmac, xid=xid)
+		request = request/UDP(sport=68, dport=67)/BOOTP(op=1, chaddr=sta.rawmac, xid=xid)
 		request = request/DHCP(options=[("message-type", "discover"), "end"])
 
 		# We assume DHCP discover is sent towards the AP.
@@ -179,6 +265,10 @@ class Action():
 		self.frame = frame
 		self.key = key
 
+		# Serialized version of a plaintext frame. This is set by Test.generate
+		# after the frame is prepared, and is the one that will be injected.
+		self.frame_raw = None
+
 	def is_meta(self, meta):
 		return self.meta_action == meta
 
@@ -200,7 +290,8 @@ class Test(metaclass=abc.ABCMeta):
 	"""
 
 	def __init__(self, actions=None):
-		self.actions = actions if actions != None else []
+		# Actions are consumed from the front, so use a deque
+		self.actions = collections.deque(actions if actions != None else [])
 		self.generated = False
 		self.delay = None
 		self.inc_pn = None
@@ -232,27 +323,32 @@ class Test(metaclass=abc.ABCMeta):
 			self.generate(station)
 			self.generated = True
 
-		act = self.actions[0]
-		del self.actions[0]
-		return act
+		return self.actions.popleft()
 
 	def check_finished(self):
+		"""Returns True when the last action has just been executed"""
 		if self.time_completed != None:
-			return
+			return False
 
 		# If this was the last action, record the time
 		if len(self.actions) == 0:
-			self.time_completed = time.time()
+			self.time_completed = time.monotonic()
 			if self.check_fn == None:
 				log(STATUS, ">>> All frames sent. You must manually check if the test succeeded (see README).", color="green")
+			return True
 
 	def get_actions(self, action):
 		return [act for act in self.actions if act.action == action]
 
+	def get_timeout(self):
+		if self.time_completed == None:
+			return None
+		return self.time_completed + 5
+
 	def timedout(self):
 		if self.time_completed == None:
 			return False
-		return self.time_completed + 5 < time.time()
+		return self.get_timeout() <= time.monotonic()
 
 	@abc.abstractmethod
 	def prepare(self, station):
@@ -262,6 +358,7 @@ class Test(metaclass=abc.ABCMeta):
 		self.prepare(station)
 		self.enforce_delay()
 		self.enforce_inc_pn()
+		self.serialize_frames()
 
 	def check(self, p):
 		if self.check_fn == None:
@@ -288,6 +385,12 @@ class Test(metaclass=abc.ABCMeta):
 		for frag in self.get_actions(Action.Inject)[1:]:
 			frag.inc_pn = self.inc_pn
 
+	def serialize_frames(self):
+		# Plaintext frames don't change anymore, so let scapy build them only once
+		for frag in self.get_actions(Action.Inject):
+			if not frag.encrypted and frag.frame != None and frag.frame_raw == None:
+				frag.frame_raw = raw(frag.frame)
+
 # ----------------------------------- Abstract Station Class -----------------------------------
 
 class Station():
@@ -313,6 +416,7 @@ class Station():
 		# MAC address and IP of the station that our script controls.
 		# Can be either an AP or client.
 		self.mac = mac
+		self.rawmac = rawmac(mac)
 		self.ip = None
 		self.ipv6 = "fe80::a00:27ff:fec6:2f54"
 
@@ -324,6 +428,9 @@ class Station():
 		self.peermac = None
 		self.peerip = None
 
+		# Serialized default headers for each priority, see get_header_raw
+		self.header_templates = dict()
+
 		# To trigger Connected event 1-2 seconds after Authentication
 		self.time_connected = None
 
@@ -362,37 +469,64 @@ class Station():
 		the tests.
 		"""
 
-		# If it contains an Ethernet header, strip it, and take addresses from that
-		p = self.get_header(prior=prior)
+		# If it contains an Ethernet header, strip it, and take addresses from that.
+		# The ethertype is also taken from it, so the payload may be given as raw bytes.
 		if Ether in data:
 			payload = data.payload
-			p.addr2 = data.src
-
-			# This tests if to-DS is set
-			if p.FCfield & 1:
-				p.addr3 = data.dst
-			else:
-				p.addr1 = data.dst
-
+			src, dst = data.src, data.dst
+			snap = SNAP(code=data.type)
 		else:
 			payload = data
+			src, dst = None, None
+			snap = SNAP()
 
 		# Add payload headers
-		payload = LLC()/SNAP()/payload
+		payload = LLC()/snap/payload
 
 		# Special case when sending EAP(OL) frames to NetBSD. Must be EAPOL/MSDU because
 		# only "EAPOL" frames are now accepted.
 		if self.options.freebsd_cache and (EAP in data or EAPOL in data):
 			log(STATUS, "Sending EAPOL as (malformed) broadcast EAPOL/A-MSDU")
+			p = self.get_header(prior=prior)
+			self.set_ether_addresses(p, src, dst)
 			p = freebsd_encap_eapolmsdu(p, self.mac, self.get_peermac(), payload)
 
-		# Normal case only need to check for encryption
+		# Encrypted frames are constructed using scapy
+		elif self.tk and not plaintext:
+			p = self.get_header(prior=prior)
+			self.set_ether_addresses(p, src, dst)
+			p, _ = self.encrypt(p/payload)
+
+		# Plaintext frames can directly use the cached header
 		else:
-			p = p/payload
-			if self.tk and not plaintext: p, _ = self.encrypt(p)
+			header = bytearray(self.get_header_raw(prior=prior))
+			if src != None:
+				header[10:16] = rawmac(src)
+				# This tests if to-DS is set
+				if header[1] & 1:
+					header[16:22] = rawmac(dst)
+				else:
+					header[4:10] = rawmac(dst)
+			p = bytes(header) + raw(payload)
 
 		self.daemon.inject_mon(p)
-		log(STATUS, "[Injected packet] " + croprepr(p))
+		if log_enabled(STATUS):
+			# Avoid parsing frames with a cached header again just to log them
+			if isinstance(p, bytes):
+				log(STATUS, "[Injected packet] " + cropstr(dot11_header_repr(header) + repr(payload)))
+			else:
+				log(STATUS, "[Injected packet] " + croprepr(p))
+
+	def set_ether_addresses(self, p, src, dst):
+		"""Use the addresses of a stripped Ethernet header in the Dot11 header p"""
+		if src == None: return
+		p.addr2 = src
+
+		# This tests if to-DS is set
+		if p.FCfield & 1:
+			p.addr3 = dst
+		else:
+			p.addr1 = dst
 
 	def set_header(self, p, prior=None):
 		"""Set addresses to send frame to the peer or the 3rd party station."""
@@ -434,13 +568,34 @@ class Station():
 		self.set_header(header, prior=prior, **kwargs)
 		return header
 
+	def get_header_raw(self, seqnum=None, prior=2):
+		"""
+		Serialized version of get_header. The header for each priority is only
+		generated once using scapy, afterwards only the sequence number is updated.
+		"""
+
+		if seqnum == None:
+			seqnum = self.seqnum
+			self.seqnum += 1
+
+		template = self.header_templates.get(prior)
+		if template == None:
+			template = bytearray(raw(self.get_header(seqnum=0, prior=prior)))
+			self.header_templates[prior] = template
+
+		# The Sequence Control field is located right after the three addresses
+		struct.pack_into("<H", template, 22, (seqnum << 4) & 0xFFFF)
+		return bytes(template)
+
 	def encrypt(self, frame, inc_pn=1, force_key=None):
 		# TODO: Add argument to force a bad authenticity check
 
 		idx = dot11_get_priority(frame) if self.options.pn_per_qos else 0
 		self.pn[idx] += inc_pn
 
-		key, keyid = (self.tk, 0) if int(frame.addr1[1], 16) & 1 == 0 else (self.gtk, self.gtk_idx)
+		# The group bit is the lowest bit of the first octet, i.e., of the second hex digit
+		is_group = frame.addr1[1] in "13579bdfBDF"
+		key, keyid = (self.gtk, self.gtk_idx) if is_group else (self.tk, 0)
 		if force_key == 0:
 			log(STATUS, "Encrypting with all-zero key")
 			key = b"\x00" * len(key)
@@ -458,12 +613,14 @@ class Station():
 	def handle_connecting(self, bss):
 		log(STATUS, f"Station: setting BSS MAC address {bss}")
 		self.bss = bss
+		self.header_templates.clear()
 
 		# Clear the keys on a new connection
 		self.reset_keys()
 
 	def set_peermac(self, peermac):
 		self.peermac = peermac
+		self.header_templates.clear()
 
 	def get_peermac(self):
 		# When being a client, the peermac may not yet be known. In that
@@ -472,18 +629,18 @@ class Station():
 			return self.bss
 		return self.peermac
 
-	def trigger_eapol_events(self, eapol):
+	def trigger_eapol_events(self, eapol, key_info):
 		# Ignore everything apart the 4-way handshake
-		if not WPA_key in eapol: return None
+		if key_info == None: return None
 
 		# Track return value of possible trigger Action function
 		result = None
 
-		key_type    = eapol.key_info & 0x0008
-		key_ack     = eapol.key_info & 0x0080
-		key_mic     = eapol.key_info & 0x0100
-		key_secure  = eapol.key_info & 0x0200
-		key_request = eapol.key_info & 0x0800
+		key_type    = key_info & 0x0008
+		key_ack     = key_info & 0x0080
+		key_mic     = key_info & 0x0100
+		key_secure  = key_info & 0x0200
+		key_request = key_info & 0x0800
 		# Detect Msg3/4 assumig WPA2 is used --- XXX support WPA1 as well
 		is_msg3_or_4 = key_secure != 0
 
@@ -498,7 +655,8 @@ class Station():
 			self.hs_state = Station.HsGotM12
 
 			if self.time_authdone == None:
-				self.time_authdone = time.time() + 6
+				self.time_authdone = time.monotonic() + 6
+				self.daemon.schedule(self.time_authdone, self.time_tick)
 
 			self.time_connected = None
 
@@ -511,8 +669,9 @@ class Station():
 		return result
 
 	def handle_eapol_tx(self, eapol, dstmac):
+		key_info = eapol_get_key_info(eapol)
 		eapol = Ether(dst=dstmac, src=self.mac)/EAPOL(eapol)
-		send_it = self.trigger_eapol_events(eapol)
+		send_it = self.trigger_eapol_events(eapol, key_info)
 
 		if send_it == None:
 			# - Send over monitor interface to assure order compared to injected fragments.
@@ -529,10 +688,17 @@ class Station():
 		if self.test == None:
 			return
 
+		# Fragments that are injected without any delay are sent as one batch
 		frame = None
+		pending = []
 		while self.test.next_trigger_is(trigger):
 			act = self.test.next_action(self)
 
+			# Frames queued by previous actions must be sent before executing other actions
+			if act.action != Action.Inject or (act.delay != None and act.delay > 0):
+				self.daemon.inject_mon_batch(pending)
+				pending = []
+
 			# TODO: Previously scheduled Connected on AfterAuth should be cancelled??
 			if act.action == Action.GetIp and not self.obtained_ip:
 				self.waiting_on_ip = True
@@ -565,22 +731,27 @@ class Station():
 				if act.encrypted:
 					assert self.tk != None and self.gtk != None
 					frame, key = self.encrypt(act.frame, inc_pn=act.inc_pn, force_key=act.key)
-					log(STATUS, "Using key " + key.hex() + " to encrypt " + repr(act.frame))
+					if log_enabled(STATUS):
+						log(STATUS, "Using key " + key.hex() + " to encrypt " + repr(act.frame))
+					pending.append(frame)
 				else:
 					frame = act.frame
+					pending.append(act.frame_raw if act.frame_raw != None else frame)
 
-				self.daemon.inject_mon(frame)
-				log(STATUS, "[Injected] " + repr(frame))
+				if log_enabled(STATUS):
+					log(STATUS, "[Injected] " + repr(frame))
 
 				if self.options.inject_mf_workaround and frame.FCfield & 0x4 != 0:
-					self.daemon.inject_mon(Dot11(addr1="ff:ff:ff:ff:ff:ff"))
+					pending.append(Dot11(addr1="ff:ff:ff:ff:ff:ff"))
 					log(DEBUG, "[Injected] Prevent bug after fragment injection")
 
 
 			# Stop processing actions if requested
 			if act.wait: break
 
-		self.test.check_finished()
+		self.daemon.inject_mon_batch(pending)
+		if self.test.check_finished():
+			self.daemon.schedule(self.test.get_timeout(), self.time_tick)
 		return result
 
 	def update_keys(self):
@@ -595,7 +766,8 @@ class Station():
 		if self.hs_state == Station.HsGotM34:
 			# Note that self.time_connect may get changed in perform_actions
 			log(STATUS, "Action.AfterAuth", color="green")
-			self.time_connected = time.time() + self.options.connected_delay
+			self.time_connected = time.monotonic() + self.options.connected_delay
+			self.daemon.schedule(self.time_connected, self.time_tick)
 			self.perform_actions(Action.AfterAuth)
 			self.hs_state = Station.HsDone
 			self.time_authdone = None
@@ -619,10 +791,12 @@ class Station():
 			self.perform_actions(Action.Connected)
 
 	def time_tick(self):
-		if self.time_connected != None and time.time() > self.time_connected:
+		"""Called by the daemon when one of the deadlines scheduled by this station expired"""
+		now = time.monotonic()
+		if self.time_connected != None and now >= self.time_connected:
 			self.time_connected = None
 			self.handle_connected()
-		elif self.time_authdone != None and time.time() > self.time_authdone:
+		elif self.time_authdone != None and now >= self.time_authdone:
 			if self.options.freebsd_cache:
 				log(ERROR, "The 4-way handshake has timed out, perhaps due to usage of the --freebsd parameter.")
 			else:
@@ -650,9 +824,16 @@ class Daemon(metaclass=abc.ABCMeta):
 		self.sock_eth = None
 		self.sock_mon = None
 		self.sock_hwsim = None
+		# Replies to ARP and DHCP requests are queued and sent together
+		self.eth_sender = None
 
 		self.wpaspy_pending = []
 
+		# Min-heap of (deadline, counter, callback). Entries are never removed early: the
+		# callback itself checks whether its deadline is still relevant.
+		self.timers = []
+		self.timer_counter = itertools.count()
+
 	@abc.abstractmethod
 	def start_daemon(self):
 		pass
@@ -666,9 +847,21 @@ class Daemon(metaclass=abc.ABCMeta):
 	def handle_eth(self, p):
 		pass
 
-	@abc.abstractmethod
-	def time_tick(self, station):
-		pass
+	def schedule(self, deadline, callback):
+		"""Call callback once time.monotonic() reaches the given deadline"""
+		heapq.heappush(self.timers, (deadline, next(self.timer_counter), callback))
+
+	def run_timers(self):
+		now = time.monotonic()
+		while len(self.timers) > 0 and self.timers[0][0] <= now:
+			_, _, callback = heapq.heappop(self.timers)
+			callback()
+
+	def get_select_timeout(self):
+		# Sleep until the nearest deadline, or until a frame or event arrives
+		if len(self.timers) == 0:
+			return None
+		return max(0, self.timers[0][0] - time.monotonic())
 
 	@abc.abstractmethod
 	def get_tk(self, station):
@@ -794,10 +987,23 @@ class Daemon(metaclass=abc.ABCMeta):
 		if self.options.inject_test != None and self.options.inject_test != "self":
 			set_monitor_mode(self.options.inject_test)
 
+	def flush_eth(self):
+		# Queued ARP and DHCP replies must arrive before test frames, e.g. the DHCP ACK before a ping
+		if self.eth_sender != None:
+			self.eth_sender.flush()
+
 	def inject_mon(self, p):
+		self.flush_eth()
 		self.sock_mon.send(p)
 
+	def inject_mon_batch(self, frames):
+		self.flush_eth()
+		# Larger batches barely reduce overhead further but do delay the first frame
+		for i in range(0, len(frames), 64):
+			self.sock_mon.send_batch(frames[i:i + 64])
+
 	def inject_eth(self, p):
+		self.flush_eth()
 		self.sock_eth.send(p)
 
 	def connect_wpaspy(self):
@@ -876,6 +1082,38 @@ class Daemon(metaclass=abc.ABCMeta):
 		p = Raw(raw(p))
 		s.send(p)
 
+	def recv_hwsim(self, p):
+		if p != None: self.forward_hwsim(p, self.sock_mon)
+
+	def recv_mon(self, p):
+		if p != None: self.handle_mon(p)
+		if self.sock_hwsim:
+			self.forward_hwsim(p, self.sock_hwsim)
+
+	def recv_eth(self, p):
+		if p != None and Ether in p: self.handle_eth(p)
+
+	def recv_all(self, sock, handler, limit=64):
+		"""Process the frames that are queued on a ready socket, up to limit frames"""
+		# The limit assures a busy channel doesn't delay the processing of events and timers
+		for i in range(limit):
+			handler(sock.recv())
+			# Only peek in non-blocking mode so that sending on the socket still blocks
+			try:
+				sock.ins.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+			except BlockingIOError:
+				return
+
+	def recv_wpaspy(self):
+		"""Process all messages that are queued on the control interface"""
+		while True:
+			# Messages received while executing a command come first to preserve their order
+			while len(self.wpaspy_pending) > 0:
+				self.handle_wpaspy(self.wpaspy_pending.pop())
+			if not self.wpaspy_ctrl.pending():
+				return
+			self.handle_wpaspy(self.wpaspy_ctrl.recv())
+
 	def run(self):
 		self.configure_interfaces()
 
@@ -885,6 +1123,9 @@ class Daemon(metaclass=abc.ABCMeta):
 		self.start_daemon()
 
 		self.sock_eth = L2Socket(type=ETH_P_ALL, iface=self.nic_iface)
+		# Let the kernel drop frames that are never handled
+		attach_bpf_program(self.sock_eth.ins, ETH_FILTER)
+		self.eth_sender = BatchSender(self.sock_eth)
 		self.sock_mon = MonitorSocket(type=ETH_P_ALL, iface=self.nic_mon)
 		if self.nic_hwsim:
 			self.sock_hwsim = MonitorSocket(type=ETH_P_ALL, iface=self.nic_hwsim)
@@ -900,33 +1141,29 @@ class Daemon(metaclass=abc.ABCMeta):
 		self.wpaspy_command("SET ext_eapol_frame_io 1")
 		self.configure_daemon()
 
-		# Monitor the virtual monitor interface of the client and perform the needed actions
-		sockets = [self.sock_mon, self.sock_eth, self.wpaspy_ctrl.s]
-		if self.sock_hwsim: sockets.append(self.sock_hwsim)
+		# Monitor the virtual monitor interface of the client and perform the needed actions.
+		# The selector is created once, and several queued frames of a ready socket are processed at once.
+		sel = selectors.DefaultSelector()
+		for sock, handler in [(self.sock_mon, self.recv_mon), (self.sock_eth, self.recv_eth), (self.sock_hwsim, self.recv_hwsim)]:
+			if sock == None: continue
+			# Let the kernel queue bursts of frames while we are still processing earlier ones. A much
+			# larger buffer would only let a busy channel build up a backlog of stale frames.
+			sock.ins.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+			sel.register(sock, selectors.EVENT_READ, handler)
+		sel.register(self.wpaspy_ctrl.s, selectors.EVENT_READ, None)
+
 		while True:
 			while len(self.wpaspy_pending) > 0:
 				self.handle_wpaspy(self.wpaspy_pending.pop())
 
-			sel = select.select(sockets, [], [], 0.5)
-			if self.sock_hwsim in sel[0]:
-				p = self.sock_hwsim.recv()
-				if p != None: self.forward_hwsim(p, self.sock_mon)
-
-			if self.sock_mon in sel[0]:
-				p = self.sock_mon.recv()
-				if p != None: self.handle_mon(p)
-				if self.sock_hwsim:
-					self.forward_hwsim(p, self.sock_hwsim)
-
-			if self.sock_eth in sel[0]:
-				p = self.sock_eth.recv()
-				if p != None and Ether in p: self.handle_eth(p)
-
-			if self.wpaspy_ctrl.s in sel[0]:
-				msg = self.wpaspy_ctrl.recv()
-				self.handle_wpaspy(msg)
+			for key, _ in sel.select(timeout=self.get_select_timeout()):
+				if key.data != None:
+					self.recv_all(key.fileobj, key.data)
+				else:
+					self.recv_wpaspy()
 
-			self.time_tick()
+			self.run_timers()
+			self.flush_eth()
 
 	def stop(self):
 		log(STATUS, "Closing daemon and cleaning up ...")
@@ -952,10 +1189,6 @@ class Authenticator(Daemon):
 		tk = self.wpaspy_command("GET_TK " + station.get_peermac())
 		return bytes.fromhex(tk)
 
-	def time_tick(self):
-		for station in self.stations.values():
-			station.time_tick()
-
 	def get_ip(self, station):
 		log(STATUS, f"Waiting on client {station.get_peermac()} to get IP")
 
@@ -979,14 +1212,15 @@ class Authenticator(Daemon):
 			cmd = f"DISASSOCIATE {station.get_peermac()} reason={WLAN_REASON_CLASS3_FRAME_FROM_NONASSOC_STA}"
 		self.wpaspy_command(cmd)
 
-	def handle_eth_dhcp(self, p, station):
-		if not DHCP in p or not station.get_peermac() in self.dhcp.leases: return
+	def handle_eth_dhcp(self, p, frame, station):
+		if bootp_get_offset(frame, to_server=True) == None or not DHCP in p: return
 
 		# This assures we only mark it as connected after receiving a DHCP Request
-		req_type = next(opt[1] for opt in p[DHCP].options if isinstance(opt, tuple) and opt[0] == 'message-type')
-		if req_type != 3: return
+		if dhcp_get_message_type(p) != 3: return
+
+		peerip = self.dhcp.leases.get(station.get_peermac())
+		if peerip == None: return
 
-		peerip = self.dhcp.leases[station.get_peermac()]
 		log(STATUS, f"Client {station.get_peermac()} with IP {peerip} has connected")
 		station.set_ip_addresses(self.arp_sender_ip, peerip)
 
@@ -995,9 +1229,10 @@ class Authenticator(Daemon):
 		# TODO: Shouldn't we handle ARP in the Station() code instead?
 
 		# Ignore clients not connected to the AP
-		clientmac = p[Ether].src
-		if not clientmac in self.stations:
+		station = self.stations.get(p[Ether].src)
+		if station is None:
 			return
+		frame = p.original or raw(p)
 
 		# Let clients get IP addresses
 		if not self.options.no_dhcp:
@@ -1005,14 +1240,14 @@ class Authenticator(Daemon):
 		self.arp_sock.reply(p)
 
 		# Monitor DHCP messages to know when a client received an IP address
-		station = self.stations[clientmac]
 		if not self.options.no_dhcp and not station.obtained_ip:
-			self.handle_eth_dhcp(p, station)
+			self.handle_eth_dhcp(p, frame, station)
 		else:
 			station.handle_eth(p)
 
 	def add_station(self, clientmac):
-		if not clientmac in self.stations:
+		station = self.stations.get(clientmac)
+		if station is None:
 			station = Station(self, self.apmac, "from-DS")
 			self.stations[clientmac] = station
 
@@ -1021,15 +1256,19 @@ class Authenticator(Daemon):
 				self.dhcp.prealloc_ip(clientmac, self.options.peerip)
 				station.set_ip_addresses(self.options.ip, self.options.peerip)
 
+		return station
+
 	def handle_wpaspy(self, msg):
-		log(DEBUG, "daemon: " + msg)
+		if log_enabled(DEBUG):
+			log(DEBUG, "daemon: " + msg)
 
-		if "AP-STA-ASSOCIATING" in msg:
-			cmd, clientmac, source = msg.split()
-			self.add_station(clientmac)
+		# Match the start of the event instead of scanning the whole message
+		event = wpaspy_get_event(msg)
+		if event.startswith("AP-STA-ASSOCIATING "):
+			cmd, clientmac, source = event.split()
+			station = self.add_station(clientmac)
 
 			log(STATUS, f"Client {clientmac} is connecting")
-			station = self.stations[clientmac]
 			station.handle_connecting(self.apmac)
 			station.set_peermac(clientmac)
 
@@ -1037,19 +1276,21 @@ class Authenticator(Daemon):
 			# So it must be executed once we are connecting so the channel is stable.
 			self.injection_test(clientmac, self.apmac, False)
 
-		elif "EAPOL-TX" in msg:
-			cmd, clientmac, payload = msg.split()
-			if not clientmac in self.stations:
+		elif event.startswith("EAPOL-TX "):
+			cmd, clientmac, payload = event.split()
+			station = self.stations.get(clientmac)
+			if station is None:
 				log(WARNING, f"Sending EAPOL to unknown client {clientmac}.")
 				return
-			self.stations[clientmac].handle_eapol_tx(bytes.fromhex(payload), clientmac)
+			station.handle_eapol_tx(bytes.fromhex(payload), clientmac)
 
-		elif "AP-STA-CONNECTED" in msg:
-			cmd, clientmac = msg.split()
-			if not clientmac in self.stations:
+		elif event.startswith("AP-STA-CONNECTED "):
+			cmd, clientmac = event.split()
+			station = self.stations.get(clientmac)
+			if station is None:
 				log(WARNING, f"Unknown client {clientmac} finished authenticating.")
 				return
-			self.stations[clientmac].handle_authenticated()
+			station.handle_authenticated()
 
 			self.injection_test(clientmac, self.apmac, True)
 
@@ -1068,7 +1309,7 @@ class Authenticator(Daemon):
 
 	def configure_daemon(self):
 		# Let scapy handle DHCP requests
-		self.dhcp = DHCP_sock(sock=self.sock_eth,
+		self.dhcp = DHCP_sock(sock=self.eth_sender,
 						domain='mathyvanhoef.com',
 						pool=Net('192.168.100.0/24'),
 						network='192.168.100.0/24',
@@ -1080,7 +1321,7 @@ class Authenticator(Daemon):
 
 		# Use a dedicated IP address for our ARP ping and replies
 		self.arp_sender_ip = self.dhcp.pool.pop()
-		self.arp_sock = ARP_sock(sock=self.sock_eth, IP_addr=self.arp_sender_ip, ARP_addr=self.apmac)
+		self.arp_sock = ARP_sock(sock=self.eth_sender, IP_addr=self.arp_sender_ip, ARP_addr=self.apmac)
 		# TODO XXX: This is no longer correct due to --ip and --peerip parameters?
 		#log(STATUS, f"Will inject ARP packets using sender IP {self.arp_sender_ip}")
 
@@ -1088,13 +1329,20 @@ class Authenticator(Daemon):
 		self.follow_channel()
 
 
+# Compiled once instead of on every message of wpa_supplicant
+REGEX_ASSOCIATED = re.compile("Associated with (.*)")
+
 class Supplicant(Daemon):
 	def __init__(self, options):
 		super().__init__(options)
 		self.station = None
 		self.arp_sock = None
-		self.dhcp_xid = None
-		self.dhcp_offer_frame = False
+		self.dhcp_xid = int.from_bytes(os.urandom(4), "big") & 0x7fffffff
+		self.dhcp_offer_ip = None
+		# DHCP messages are built once and reused on retransmissions
+		self.dhcp_discover = None
+		self.dhcp_request = None
+		self.dhcp_request_ip = None
 		self.time_retrans_dhcp = None
 		self.time_rekey_req = None
 
@@ -1106,12 +1354,13 @@ class Supplicant(Daemon):
 			return bytes.fromhex(tk)
 
 	def get_ip(self, station):
-		if not self.dhcp_offer_frame:
+		if self.dhcp_offer_ip == None:
 			self.send_dhcp_discover()
 		else:
-			self.send_dhcp_request(self.dhcp_offer_frame)
+			self.send_dhcp_request(self.dhcp_offer_ip)
 
-		self.time_retrans_dhcp = time.time() + 2.5
+		self.time_retrans_dhcp = time.monotonic() + 2.5
+		self.schedule(self.time_retrans_dhcp, self.time_tick)
 
 	def rekey(self, station):
 		# WAG320N: does not work (Broadcom - no reply)
@@ -1125,64 +1374,61 @@ class Supplicant(Daemon):
 		if self.options.rekey_request:
 			log(STATUS, "Actively requesting PTK rekey", color="green")
 			self.wpaspy_command("KEY_REQUEST 0 1")
-			self.time_rekey_req = time.time() + 4
+			self.time_rekey_req = time.monotonic() + 4
+			self.schedule(self.time_rekey_req, self.time_tick)
 		else:
 			log(STATUS, "Client cannot force rekey. Waiting on AP to start PTK rekey.", color="orange")
 
 	def time_tick(self):
-		if self.time_retrans_dhcp != None and time.time() > self.time_retrans_dhcp:
+		now = time.monotonic()
+		if self.time_retrans_dhcp != None and now >= self.time_retrans_dhcp:
 			log(WARNING, "Retransmitting DHCP message", color="orange")
 			self.get_ip(self)
 
-		if self.time_rekey_req != None and time.time() > self.time_rekey_req:
+		if self.time_rekey_req != None and now >= self.time_rekey_req:
 			self.time_rekey_req = None
 			log(ERROR, "Rekey request timed out. Configure AP to periodically renew PTK instead.")
 			self.station.stop_test()
 
-		self.station.time_tick()
-
 	def send_dhcp_discover(self):
-		if self.dhcp_xid == None:
-			self.dhcp_xid = random.randint(0, 2**31)
-
-		rawmac = bytes.fromhex(self.station.mac.replace(':', ''))
-		req = Ether(dst="ff:ff:ff:ff:ff:ff", src=self.station.mac)/IP(src="0.0.0.0", dst="255.255.255.255")
-		req = req/UDP(sport=68, dport=67)/BOOTP(op=1, chaddr=rawmac, xid=self.dhcp_xid)
-		req = req/DHCP(options=[("message-type", "discover"), "end"])
+		if self.dhcp_discover == None:
+			req = dhcp_build_message(self.dhcp_xid, self.station.rawmac, [(53, b"\x01")])
+			self.dhcp_discover = Ether(dst="ff:ff:ff:ff:ff:ff", src=self.station.mac, type=0x0800)/Raw(req)
 
 		log(STATUS, f"Sending DHCP discover with XID {self.dhcp_xid}")
-		self.station.send_mon(req)
-
-	def send_dhcp_request(self, offer):
-		rawmac = bytes.fromhex(self.station.mac.replace(':', ''))
-		myip = offer[BOOTP].yiaddr
-		sip = offer[BOOTP].siaddr
-		xid = offer[BOOTP].xid
+		self.station.send_mon(self.dhcp_discover)
 
-		reply = Ether(dst="ff:ff:ff:ff:ff:ff", src=self.station.mac)/IP(src="0.0.0.0", dst="255.255.255.255")
-		reply = reply/UDP(sport=68, dport=67)/BOOTP(op=1, chaddr=rawmac, xid=self.dhcp_xid)
-		reply = reply/DHCP(options=[("message-type", "request"), ("requested_addr", myip),
-					    ("hostname", "fragclient"), "end"])
+	def send_dhcp_request(self, myip):
+		# Only rebuild the request when a different IP address is offered
+		if self.dhcp_request == None or self.dhcp_request_ip != myip:
+			reply = dhcp_build_message(self.dhcp_xid, self.station.rawmac, [(53, b"\x03"),
+					(50, socket.inet_aton(myip)), (12, b"fragclient")])
+			self.dhcp_request = Ether(dst="ff:ff:ff:ff:ff:ff", src=self.station.mac, type=0x0800)/Raw(reply)
+			self.dhcp_request_ip = myip
 
 		log(STATUS, f"Sending DHCP request with XID {self.dhcp_xid}")
-		self.station.send_mon(reply)
+		self.station.send_mon(self.dhcp_request)
 
-	def handle_eth_dhcp(self, p):
+	def handle_eth_dhcp(self, p, frame):
 		"""Handle packets needed to connect and request an IP"""
 		if not DHCP in p: return
 
-		req_type = next(opt[1] for opt in p[DHCP].options if isinstance(opt, tuple) and opt[0] == 'message-type')
+		req_type = dhcp_get_message_type(p)
+
+		# The offered address (yiaddr) is at a fixed offset in the BOOTP header
+		offset = bootp_get_offset(frame)
+		yiaddr = socket.inet_ntoa(frame[offset + 16:offset + 20])
 
 		# DHCP Offer
 		if req_type == 2:
 			log(STATUS, "Received DHCP offer, sending DHCP request.")
-			self.send_dhcp_request(p)
-			self.dhcp_offer_frame = p
+			self.send_dhcp_request(yiaddr)
+			self.dhcp_offer_ip = yiaddr
 
 		# DHCP Ack
 		elif req_type == 5:
-			clientip = p[BOOTP].yiaddr
-			serverip = p[IP].src
+			clientip = yiaddr
+			serverip = socket.inet_ntoa(frame[26:30])
 			self.time_retrans_dhcp = None
 			log(STATUS, f"Received DHCP ack. My ip is {clientip} and router is {serverip}.", color="green")
 
@@ -1195,15 +1441,17 @@ class Supplicant(Daemon):
 		self.station.set_peermac(peermac)
 
 	def initialize_ips(self, clientip, serverip):
-		self.arp_sock = ARP_sock(sock=self.sock_eth, IP_addr=clientip, ARP_addr=self.station.mac)
+		self.arp_sock = ARP_sock(sock=self.eth_sender, IP_addr=clientip, ARP_addr=self.station.mac)
 		self.station.set_ip_addresses(clientip, serverip)
 
 	def handle_eth(self, p):
-		if BOOTP in p and p[BOOTP].xid == self.dhcp_xid:
-			self.handle_eth_dhcp(p)
+		# Check the raw frame to avoid searching the layers of all other frames
+		frame = p.original or raw(p)
+		if bootp_get_xid(frame) == self.dhcp_xid:
+			self.handle_eth_dhcp(p, frame)
 		else:
 			# Assume any EAPOL reply means rekey request worked (this isn't 100% accurate but should do)
-			if EAPOL in p:
+			if frame[12:14] == b"\x88\x8e":
 				self.time_rekey_req = None
 
 			if self.arp_sock != None:
@@ -1211,27 +1459,29 @@ class Supplicant(Daemon):
 			self.station.handle_eth(p)
 
 	def handle_wpaspy(self, msg):
-		log(DEBUG, "daemon: " + msg)
+		if log_enabled(DEBUG):
+			log(DEBUG, "daemon: " + msg)
+
+		# Match the start of the event instead of scanning the whole message. EAPOL-TX
+		# is checked first because it is the most frequent event.
+		event = wpaspy_get_event(msg)
+		if event.startswith("EAPOL-TX "):
+			cmd, dstmac, payload = event.split()
+			self.station.handle_eapol_tx(bytes.fromhex(payload), dstmac)
 
-		if "Associated with" in msg:
+		elif event.startswith("Associated with "):
 			# When using a separate interface to inject, switch to correct channel
 			self.follow_channel()
 
-			p = re.compile("Associated with (.*)")
-			bss = p.search(msg).group(1)
+			bss = REGEX_ASSOCIATED.match(event).group(1)
 			self.station.handle_connecting(bss)
 
 			# With the ath9k_htc, injection in mixed managed/monitor only works after
 			# sending the association request. So only perform injection test now.
 			self.injection_test(self.station.bss, self.station.mac, False)
 
-		elif "EAPOL-TX" in msg:
-			cmd, dstmac, payload = msg.split()
-			self.station.handle_eapol_tx(bytes.fromhex(payload), dstmac)
-
 		# The "EAPOL processing" event only occurs with WEP
-		if "WPA: Key negotiation completed with" in msg or \
-		   "WPA: EAPOL processing complete" in msg:
+		elif event.startswith(("WPA: Key negotiation completed with", "WPA: EAPOL processing complete")):
 			# This get's the current keys
 			self.station.handle_authenticated()
 
@@ -32,9 +32,9 @@ def ccmp_get_nonce(priority, addr, pn):
 	return struct.pack("B", priority) + addr2bin(addr) + pn2bin(pn)
 
 def ccmp_get_aad(p, amsdu_spp=False):
-	# FC field with masked values
-	fc = raw(p)[:2]
-	fc = struct.pack("<BB", fc[0] & 0x8f, fc[1] & 0xc7)
+	# FC field with masked values. Construct it from the fields to avoid building the whole frame.
+	fc = (p.subtype << 4) | (p.type << 2) | p.proto
+	fc = struct.pack("<BB", fc & 0x8f, int(p.FCfield) & 0xc7)
 
 	# Sequence number is masked, but fragment number is included
 	sc = struct.pack("<H", p.SC & 0xf)
@@ -61,7 +61,7 @@ def encrypt_ccmp(p, tk, pn, keyid=0, amsdu_spp=False):
 
 	# Update the FC field
 	p = p.copy()
-	p.FCfield |= Dot11(FCfield="protected").FCfield
+	p.FCfield |= 0x40
 	if Dot11QoS in p:
 		payload = raw(p[Dot11QoS].payload)
 		p[Dot11QoS].remove_payload()
@@ -91,8 +91,7 @@ def encrypt_ccmp(p, tk, pn, keyid=0, amsdu_spp=False):
 	#print("Payload:", payload.hex())
 	cipher = AES.new(tk, AES.MODE_CCM, ccm_nonce, mac_len=8)
 	cipher.update(ccm_aad)
-	ciphertext = cipher.encrypt(payload)
-	digest = cipher.digest()
+	ciphertext, digest = cipher.encrypt_and_digest(payload)
 	newp = newp/Raw(ciphertext)
 	newp = newp/Raw(digest)
 
@@ -9,9 +9,6 @@ from Crypto.Hash import HMAC, SHA256
 from Crypto.PublicKey import ECC
 from Crypto.Math.Numbers import Integer
 
-# Alternative is https://eli.thegreenplace.net/2009/03/07/computing-modular-square-roots-in-python
-from sympy.ntheory.residue_ntheory import sqrt_mod_iter
-
 # ----------------------- Utility ---------------------------------
 
 def int_to_data(num):
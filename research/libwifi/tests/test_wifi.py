@@ -0,0 +1,59 @@
+from libwifi.wifi import *
+from types import SimpleNamespace
+import socket
+
+def recv_all(sock):
+	frames = []
+	while True:
+		try:
+			frames.append(sock.recv(2048))
+		except BlockingIOError:
+			return frames
+
+def test_sendmmsg():
+	sout, sin = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+	sin.setblocking(False)
+
+	# The buffers of one message form a single frame
+	assert sendmmsg(sout, [[b"\x01\x02", b"\x03"], [b"\x04"], [b"", b"\x05\x06"]]) == 3
+	assert recv_all(sin) == [b"\x01\x02\x03", b"\x04", b"\x05\x06"]
+
+	# When the socket buffer is full, the number of frames that were sent is returned
+	sout.setblocking(False)
+	sent = sendmmsg(sout, [[b"A" * 1000]] * 1000)
+	assert 0 < sent < 1000
+	assert len(recv_all(sin)) == sent
+
+def test_batchsender():
+	sout, sin = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+	sin.setblocking(False)
+	sender = BatchSender(SimpleNamespace(outs=sout), maxlen=4)
+
+	# Frames are queued until flush() is called
+	sender.send(Raw(b"first"))
+	assert recv_all(sin) == []
+	sender.flush()
+	assert recv_all(sin) == [b"first"]
+	sender.flush()
+	assert recv_all(sin) == []
+
+	# The queue is flushed automatically once it contains maxlen frames
+	frames = [Raw(b"frame%d" % i) for i in range(6)]
+	for p in frames[:3]:
+		sender.send(p)
+	assert recv_all(sin) == []
+	for p in frames[3:]:
+		sender.send(p)
+	assert recv_all(sin) == [raw(p) for p in frames[:4]]
+	sender.flush()
+	assert recv_all(sin) == [raw(p) for p in frames[4:]]
+
+def test_ethertype_filter():
+	sout, sin = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+	sin.setblocking(False)
+	attach_bpf_program(sin, compile_ethertype_filter([ETH_P_ARP, 0x888e]))
+
+	frames = [raw(Ether(type=ethertype)/Raw(b"payload")) for ethertype in [ETH_P_ARP, ETH_P_IP, 0x888e, ETH_P_IPV6]]
+	for frame in frames:
+		sout.send(frame)
+	assert recv_all(sin) == [frames[0], frames[2]]
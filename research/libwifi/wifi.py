@@ -3,9 +3,10 @@
 # This code may be distributed under the terms of the BSD license.
 # See README for more details.
 from scapy.all import *
+from scapy.arch.common import get_bpf_pointer
 from Crypto.Cipher import AES
 from datetime import datetime
-import binascii
+import binascii, ctypes, errno, fcntl, socket, struct
 
 #### Constants ####
 
@@ -26,6 +27,12 @@ IEEE80211_RADIOTAP_CHANNEL = (1 << 3)
 IEEE80211_RADIOTAP_TX_FLAGS = (1 << 15)
 IEEE80211_RADIOTAP_DATA_RETRIES = (1 << 17)
 
+SIOCGIFFLAGS = 0x8913
+SIOCSIFFLAGS = 0x8914
+SIOCSIFMTU   = 0x8922
+IFF_UP       = 0x1
+ARPHRD_IEEE80211_RADIOTAP = 803
+
 #### Basic output and logging functionality ####
 
 ALL, DEBUG, INFO, STATUS, WARNING, ERROR = range(6)
@@ -47,6 +54,10 @@ def change_log_level(delta):
 	global global_log_level
 	global_log_level += delta
 
+def log_enabled(level):
+	"""Use this to avoid formatting expensive log messages that would not be shown"""
+	return level >= global_log_level
+
 def croprepr(p, length=175):
 	string = repr(p)
 	if len(string) > length:
@@ -108,9 +119,29 @@ def set_channel(iface, channel):
 def set_macaddress(iface, macaddr):
 	# macchanger throws an error if the interface already has the given MAC address
 	if get_macaddress(iface) != macaddr:
-		subprocess.check_output(["ifconfig", iface, "down"])
+		set_iface_up(iface, False)
 		subprocess.check_output(["macchanger", "-m", macaddr, iface])
 
+def set_iface_up(iface, up=True):
+	"""Equivalent of `ifconfig iface up/down` using an ioctl instead of a subprocess"""
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+		ifreq = struct.pack("16sH22x", iface.encode(), 0)
+		flags = struct.unpack("16sH22x", fcntl.ioctl(s, SIOCGIFFLAGS, ifreq))[1]
+		newflags = flags | IFF_UP if up else flags & ~IFF_UP
+		if newflags != flags:
+			fcntl.ioctl(s, SIOCSIFFLAGS, struct.pack("16sH22x", iface.encode(), newflags))
+
+def set_iface_mtu(iface, mtu):
+	with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+		fcntl.ioctl(s, SIOCSIFMTU, struct.pack("16si20x", iface.encode(), mtu))
+
+def is_monitor_mode(iface):
+	# Monitor interfaces use radiotap as link type. This avoids calling `iw` to get the type.
+	try:
+		return int(open("/sys/class/net/%s/type" % iface).read()) == ARPHRD_IEEE80211_RADIOTAP
+	except (IOError, ValueError):
+		return get_iface_type(iface) == "monitor"
+
 def get_iface_type(iface):
 	output = str(subprocess.check_output(["iw", iface, "info"]))
 	p = re.compile("type (\w+)")
@@ -119,17 +150,31 @@ def get_iface_type(iface):
 def set_monitor_mode(iface, up=True, mtu=1500):
 	# Note: we let the user put the device in monitor mode, such that they can control optional
 	#       parameters such as "iw wlan0 set monitor active" for devices that support it.
-	if get_iface_type(iface) != "monitor":
+	if not is_monitor_mode(iface):
 		# Some kernels (Debian jessie - 3.16.0-4-amd64) don't properly add the monitor interface. The following ugly
 		# sequence of commands assures the virtual interface is properly registered as a 802.11 monitor interface.
-		subprocess.check_output(["ifconfig", iface, "down"])
+		set_iface_up(iface, False)
 		subprocess.check_output(["iw", iface, "set", "type", "monitor"])
 		time.sleep(0.5)
 		subprocess.check_output(["iw", iface, "set", "type", "monitor"])
 
 	if up:
-		subprocess.check_output(["ifconfig", iface, "up"])
-	subprocess.check_output(["ifconfig", iface, "mtu", str(mtu)])
+		set_iface_up(iface)
+	set_iface_mtu(iface, mtu)
+
+def compile_ethertype_filter(ethertypes):
+	"""Build a BPF program that only accepts frames with one of the given ethertypes"""
+	# BPF program: ldh [12]; jeq #ethertype for each type; ret #0; ret #262144
+	num = len(ethertypes)
+	lines = [str(num + 3), "40 0 0 12"]
+	for i, ethertype in enumerate(ethertypes):
+		lines.append(f"21 {num - i} 0 {ethertype}")
+	lines += ["6 0 0 0", "6 0 0 262144"]
+	return get_bpf_pointer(lines)
+
+def attach_bpf_program(sock, bpf):
+	"""Let the kernel drop all received frames that are rejected by the given BPF program"""
+	sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bpf)
 
 def rawmac(addr):
 	return bytes.fromhex(addr.replace(':', ''))
@@ -192,6 +237,12 @@ class ARP_sock(ARP_am):
 		self.sock = kwargs.pop("sock")
 		super(ARP_am, self).__init__(**kwargs)
 
+	def is_request(self, req):
+		# Checking the ethertype first avoids searching all layers of every non-ARP frame
+		if not isinstance(req, Ether) or req.type != ETH_P_ARP:
+			return False
+		return super().is_request(req)
+
 	def send_reply(self, reply):
 		self.sock.send(reply, **self.optsend)
 
@@ -199,6 +250,96 @@ class ARP_sock(ARP_am):
 		log(STATUS, "%s: ARP: %s ==> %s on %s" % (reply.getlayer(Ether).dst, req.summary(), reply.summary(), self.iff))
 
 
+#### Batched transmission ####
+
+class iovec(ctypes.Structure):
+	_fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+	_fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+	            ("msg_iov", ctypes.c_void_p), ("msg_iovlen", ctypes.c_size_t),
+	            ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+	            ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+	_fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+try:
+	libc_sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+	libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+	libc_sendmmsg.restype = ctypes.c_int
+except (OSError, AttributeError):
+	libc_sendmmsg = None
+
+def sendmmsg(sock, messages):
+	"""
+	Send multiple frames over a connected or bound socket using a single system call.
+	Each message is a list of bytes objects that together form one frame. These are
+	handed to the kernel using scatter/gather IO so they are never concatenated.
+
+	Returns the number of frames that were sent. This stops at the first error, so the
+	caller can send the remaining frames individually to get the error of that frame.
+	"""
+	# Fall back to individual send calls when sendmmsg is not available
+	if libc_sendmmsg is None:
+		for buffers in messages:
+			sock.sendmsg(buffers)
+		return len(messages)
+
+	# The iovecs point directly to the memory of the bytes objects, avoiding a copy
+	cbufs = [ctypes.c_char_p(buf) for buffers in messages for buf in buffers]
+	iovs = (iovec * len(cbufs))()
+	msgs = (mmsghdr * len(messages))()
+	pos = 0
+	for i, buffers in enumerate(messages):
+		msgs[i].msg_hdr.msg_iov = ctypes.addressof(iovs) + pos * ctypes.sizeof(iovec)
+		msgs[i].msg_hdr.msg_iovlen = len(buffers)
+		for buf in buffers:
+			iovs[pos].iov_base = ctypes.cast(cbufs[pos], ctypes.c_void_p).value
+			iovs[pos].iov_len = len(buf)
+			pos += 1
+
+	# The kernel may send fewer frames than requested, so continue where it stopped
+	num = len(messages)
+	sent = 0
+	while sent < num:
+		rval = libc_sendmmsg(sock.fileno(), ctypes.addressof(msgs) + sent * ctypes.sizeof(mmsghdr), num - sent, 0)
+		if rval < 0:
+			if ctypes.get_errno() == errno.EINTR: continue
+			return sent
+		sent += rval
+	return sent
+
+class BatchSender():
+	"""
+	Can be used instead of a socket to queue the frames given to send(). All queued
+	frames are transmitted using a single sendmmsg call when flush() is called.
+	Send errors are logged by flush() instead of being raised.
+	"""
+	def __init__(self, sock, maxlen=16):
+		self.sock = sock
+		self.maxlen = maxlen
+		self.pending = []
+
+	def send(self, p, **kwargs):
+		self.pending.append(p)
+		# Avoid delaying frames for too long
+		if len(self.pending) >= self.maxlen:
+			self.flush()
+
+	def flush(self):
+		if len(self.pending) == 0: return
+		pending, self.pending = self.pending, []
+		sent = sendmmsg(self.sock.outs, [[raw(p)] for p in pending])
+
+		# On errors, use the normal send function of the socket so scapy can e.g. pad short frames
+		for p in pending[sent:]:
+			try:
+				self.sock.send(p)
+			except OSError as ex:
+				log(WARNING, f"Failed to send {p.summary()}: {ex}")
+
+
 #### Packet Processing Functions ####
 
 # Compatibility with older Scapy versions
@@ -213,6 +354,7 @@ class MonitorSocket(L2Socket):
 			self.pcap = PcapWriter("%s.%s.pcap" % (dumpfile, self.iface), append=False, sync=True)
 		self.detect_injected = detect_injected
 		self.default_rate = None
+		self.radiotap_raw = None
 
 	def set_channel(self, channel):
 		subprocess.check_output(["iw", self.iface, "set", "channel", str(channel)])
@@ -224,21 +366,38 @@ class MonitorSocket(L2Socket):
 	def set_default_rate(self, rate):
 		self.default_rate = rate
 
-	def send(self, p, rate=None):
+	def _add_radiotap(self, p, rate=None):
+		"""Returns the serialized radiotap header and frame as two separate buffers"""
 		# Hack: set the More Data flag so we can detect injected frames (and so clients stay awake longer)
 		if self.detect_injected:
+			if isinstance(p, bytes): p = Dot11(p)
 			p.FCfield |= 0x20
 
-		# Control data rate injected frames
+		# Control data rate injected frames. The default radiotap header is only built once.
 		if rate is None and self.default_rate is None:
-			rtap = RadioTap(present="TXFlags", TXFlags="NOSEQ+ORDER")
+			if self.radiotap_raw is None:
+				self.radiotap_raw = raw(RadioTap(present="TXFlags", TXFlags="NOSEQ+ORDER"))
+			rtap = self.radiotap_raw
 		else:
 			use_rate = rate if rate != None else self.default_rate
-			rtap = RadioTap(present="TXFlags+Rate", Rate=use_rate, TXFlags="NOSEQ+ORDER")
+			rtap = raw(RadioTap(present="TXFlags+Rate", Rate=use_rate, TXFlags="NOSEQ+ORDER"))
 
-		L2Socket.send(self, rtap/p)
+		return [rtap, p if isinstance(p, bytes) else raw(p)]
+
+	def send(self, p, rate=None):
+		self.outs.sendmsg(self._add_radiotap(p, rate))
 		if self.pcap: self.pcap.write(RadioTap()/p)
 
+	def send_batch(self, ps, rate=None):
+		"""Inject several frames using one sendmmsg system call"""
+		sent = sendmmsg(self.outs, [self._add_radiotap(p, rate) for p in ps])
+		if self.pcap:
+			for p in ps[:sent]: self.pcap.write(RadioTap()/p)
+
+		# On errors, send the remaining frames one by one so no fragment is silently dropped
+		for p in ps[sent:]:
+			self.send(p, rate)
+
 	def _strip_fcs(self, p):
 		"""
 		Scapy may throw exceptions when handling malformed short frames,
@@ -4,7 +4,7 @@
 # See README for more details.
 
 from fraginternals import *
-import copy
+import copy, collections
 
 class FragInfo:
 	def __init__(self, num=0, morefrag=False):
@@ -42,7 +42,7 @@ class PingTest(Test):
 				                            if act.action == Action.Inject]
 
 		# Remove all MetaDrop actions
-		self.actions = list(filter(lambda act: not act.is_meta(Action.MetaDrop), self.actions))
+		self.actions = collections.deque(filter(lambda act: not act.is_meta(Action.MetaDrop), self.actions))
 
 	def prepare(self, station):
 		log(STATUS, "Generating ping test", color="green")
@@ -74,7 +74,7 @@ class PingTest(Test):
 			if self.bcast_ra:
 				frame.addr1 = "ff:ff:ff:ff:ff:ff"
 			if self.bcast_dst:
-				if header.FCfield & Dot11(FCfield="to-DS").FCfield != 0:
+				if header.FCfield & 1 != 0:
 					frame.addr3 = "ff:ff:ff:ff:ff:ff"
 				else:
 					frame.addr1 = "ff:ff:ff:ff:ff:ff"
@@ -83,27 +83,36 @@ class PingTest(Test):
 			fraginfo = self.fraginfos.pop(0)
 			frame.SC = (frame.SC & 0xfff0) | fraginfo.num
 			if fraginfo.morefrag:
-				frame.FCfield |= Dot11(FCfield="MF").FCfield
+				frame.FCfield |= 0x4
 
 			frag.frame = frame
 
 			# Take into account encryption options
 			frag.bad_mic = self.bad_mic
 
-		# Put the separator after each fragment if requested.
+		# Put the separator after each fragment if requested. Build the new sequence
+		# in one pass instead of inserting into the middle of the deque.
 		if self.separate_with != None:
-			for i in range(len(self.actions) - 1, 0, -1):
-				# Check if the previous action is indeed an injection
-				prev_frag = self.actions[i - 1]
-				if prev_frag.action != Action.Inject:
+			# All separators are identical, so they share one frame and its serialization
+			separator = self.separate_with.copy()
+			station.set_header(separator)
+			separator_raw = raw(separator)
+
+			actions = collections.deque()
+			for i, prev_frag in enumerate(self.actions):
+				actions.append(prev_frag)
+
+				# Check if this is an injection that is followed by another action
+				if prev_frag.action != Action.Inject or i == len(self.actions) - 1:
 					continue
 
 				# Create a similar inject action for the seperator
 				sep_frag = Action(prev_frag.trigger, enc=prev_frag.encrypted)
-				sep_frag.frame = self.separate_with.copy()
-				station.set_header(sep_frag.frame)
+				sep_frag.frame = separator
+				sep_frag.frame_raw = separator_raw
 
-				self.actions.insert(i, sep_frag)
+				actions.append(sep_frag)
+			self.actions = actions
 
 class ForwardTest(Test):
 	def __init__(self, eapol=False, dst=None, large=False):
@@ -125,7 +134,7 @@ class ForwardTest(Test):
 	def prepare(self, station):
 		# Construct the header of the frame
 		header = station.get_header(prior=2)
-		if header.FCfield & Dot11(FCfield="to-DS").FCfield == 0:
+		if header.FCfield & 1 == 0:
 			log(ERROR, "It makes no sense to test whether a client forwards frames??")
 
 		if self.dst == None:
@@ -205,7 +214,8 @@ class EapolTest(Test):
 		request = LLC()/SNAP()/EAPOL()/EAP()/Raw(b"A"*32)
 		frag1, frag2 = create_fragments(header, data=request, num_frags=2)
 
-		frag1copy, frag2copy = create_fragments(header, data=request, num_frags=2)
+		# Copying the fragments is cheaper than splitting the request again
+		frag1copy, frag2copy = frag1.copy(), frag2.copy()
 		frag1copy.addr1 = "ff:ff:ff:ff:ff:ff"
 		frag2copy.addr1 = "ff:ff:ff:ff:ff:ff"
 
@@ -261,7 +271,7 @@ class EapolAmsduTest(Test):
 
 		# Make sure addr1/3 matches the destination address in the A-MSDU subframe(s)
 		if self.bcast_dst:
-			if toinject.FCfield & Dot11(FCfield="to-DS").FCfield != 0:
+			if toinject.FCfield & 1 != 0:
 				toinject.addr3 = "ff:ff:ff:ff:ff:ff"
 			else:
 				toinject.addr1 = "ff:ff:ff:ff:ff:ff"